@@ -5,10 +5,14 @@ Dashboard plugin.
 | `voxel51.com <https://voxel51.com/>`_
 |
 """
+from collections import OrderedDict
 from enum import Enum
-import random
+import functools
+import logging
 from textwrap import dedent
+import threading
 
+from bson import json_util
 import numpy as np
 
 import fiftyone as fo
@@ -34,10 +38,52 @@ class PlotType(Enum):
 
 NUMERIC_TYPES = (fo.IntField, fo.FloatField)
 CATEGORICAL_TYPES = (fo.StringField, fo.BooleanField)
-REQUIRES_X = [PlotType.SCATTER, PlotType.LINE, PlotType.NUMERIC_HISTOGRAM]
-REQUIRES_Y = [PlotType.SCATTER, PlotType.LINE]
+REQUIRES_FIELD = frozenset([PlotType.CATEGORICAL_HISTOGRAM, PlotType.PIE])
+REQUIRES_X = frozenset(
+    [PlotType.SCATTER, PlotType.LINE, PlotType.NUMERIC_HISTOGRAM]
+)
+REQUIRES_Y = frozenset([PlotType.SCATTER, PlotType.LINE])
+PLOTLY_PLOT_TYPES = {
+    PlotType.CATEGORICAL_HISTOGRAM: PlotlyPlotType.BAR,
+    PlotType.NUMERIC_HISTOGRAM: PlotlyPlotType.BAR,
+    PlotType.LINE: PlotlyPlotType.LINE,
+    PlotType.SCATTER: PlotlyPlotType.SCATTER,
+    PlotType.PIE: PlotlyPlotType.PIE,
+}
 CONFIGURE_PLOT_URI = "@voxel51/dashboard/configure_plot"
 
+logger = logging.getLogger(__name__)
+
+
+class _LRUCache(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._cache:
+                return default
+
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+
+# Field paths of each type, keyed by schema version and field types
+_SCHEMA_CACHE = _LRUCache(32)
+
+# Histogram and pie preview data, keyed by collection version, samples
+# version and plot data config
+_PREVIEW_CACHE = _LRUCache(8)
+
 
 class DashboardPanel(foo.Panel):
     @property
@@ -59,12 +105,14 @@ class DashboardPanel(foo.Panel):
 
     def on_change_view(self, ctx):
         dashboard_state = DashboardState(ctx)
+        reloaded = []
         for item in dashboard_state.items:
             if item.update_on_change:
                 data = dashboard_state.load_plot_data(item.name)
                 dashboard_state._data[item.name] = data
+                reloaded.append(item.name)
 
-        dashboard_state.apply_data()
+        dashboard_state.apply_data(only=reloaded)
 
     def on_add(self, ctx):
         if _can_edit(ctx):
@@ -82,7 +130,10 @@ class DashboardPanel(foo.Panel):
         code = result.get("code", None)
         update_on_change = result.get("update_on_change", None)
         with DashboardState(ctx) as dashboard_state:
-            name = result.get("name", dashboard_state.get_next_item_id())
+            name = result.get("name", None)
+            if name is None:
+                name = dashboard_state.get_next_item_id()
+
             item = DashboardPlotItem(
                 name=name,
                 type=plot_type,
@@ -182,20 +233,10 @@ class DashboardPanel(foo.Panel):
             if range:
                 x = ctx.params.get("x")
                 y = ctx.params.get("y")
-                filter = {}
-                filter[x_field] = x
-                filter[y_field] = y
-                ctx.trigger(
-                    "set_view",
-                    dict(
-                        view=[
-                            {
-                                "_cls": "fiftyone.core.stages.Match",
-                                "kwargs": [["filter", filter]],
-                            }
-                        ]
-                    ),
+                view = _make_view_for_point(
+                    dashboard_state.view, x_field, x, y_field, y
                 )
+                ctx.ops.set_view(view=view)
 
         if item.type == PlotType.PIE:
             category = ctx.params.get("label")
@@ -536,7 +577,15 @@ class ConfigurePlot(foo.Operator):
 
             dashboard_state = DashboardState(ctx)
             if dashboard_state.can_load_data(item):
-                preview_data = dashboard_state.load_plot_data_for_item(item)
+                if item.use_code:
+                    # Custom code may depend on more than the view, so its
+                    # output is never cached
+                    preview_data = dashboard_state.load_plot_data_for_item(
+                        item
+                    )
+                else:
+                    preview_data = _load_preview_data(dashboard_state, item)
+
                 preview_container = inputs.grid(
                     "grid", height="400px", width="100%"
                 )
@@ -546,7 +595,7 @@ class ConfigurePlot(foo.Operator):
                     label="Plot preview",
                     config=preview_config,
                     layout=preview_layout,
-                    data=preview_data,
+                    data=_to_json_data(preview_data),
                     height=preview_height,
                     width="600px",
                 )
@@ -558,10 +607,11 @@ class ConfigurePlot(foo.Operator):
         return types.Property(inputs, view=prompt)
 
     def execute(self, ctx):
-        plot_config = ctx.params
-        plot_config.pop("panel_state")
+        plot_config = {
+            k: v for k, v in ctx.params.items() if k != "panel_state"
+        }
         plotly_layout_and_config = _get_plotly_config_and_layout(plot_config)
-        return {**ctx.params, **plotly_layout_and_config}
+        return {**plot_config, **plotly_layout_and_config}
 
 
 class DashboardPlotProperty(types.Property):
@@ -652,6 +702,26 @@ class DashboardPlotItem(object):
         raw_params = self.raw_params or {}
         return raw_params.get("plot_title", self.name)
 
+    @property
+    def data_key(self):
+        """A string that identifies the config that determines this item's
+        data.
+        """
+        return json_util.dumps(
+            [
+                self.type.value,
+                self.use_code,
+                self.code,
+                self.x_field,
+                self.y_field,
+                self.field,
+                self.bins,
+                self.order,
+                self.reverse,
+                self.limit,
+            ]
+        )
+
     def to_configure_plot_params(self):
         return {**self.raw_params, "name": self.name}
 
@@ -681,6 +751,8 @@ class DashboardState(object):
         self.panel = ctx.panel
         self._data = {}
         self._items = {}
+        self._dirty = set()
+        self._next_id = ctx.panel.get_state("items_next_id", 0)
 
         items = ctx.panel.get_state("items_config")
         if items:
@@ -690,8 +762,12 @@ class DashboardState(object):
     def __enter__(self):
         return self
 
-    def __exit__(self, *args):
-        self.apply_state()
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Don't persist partial changes if the block raised
+        if exc_type is None:
+            self.apply_state()
+
+        return False
 
     @property
     def is_empty(self):
@@ -709,17 +785,33 @@ class DashboardState(object):
     def item_count(self):
         return len(self._items)
 
-    def items_as_dict(self):
-        return {k: v.to_dict() for k, v in self._items.items()}
-
     def apply_state(self):
+        if not self._dirty:
+            return
+
+        # Only serialize the items that were added, edited, or removed
         self.ctx.panel.state.items = None
-        items_dict = self.items_as_dict()
+        items_dict = dict(self.panel.get_state("items_config") or {})
+        for item_id in self._dirty:
+            item = self._items.get(item_id, None)
+            if item is not None:
+                items_dict[item_id] = item.to_dict()
+            else:
+                items_dict.pop(item_id, None)
+
         self.panel.set_state("items_config", items_dict)
+        self.panel.set_state("items_next_id", self._next_id)
+        self._dirty.clear()
+
+    def apply_data(self, only=None):
+        item_ids = self._data.keys() if only is None else only
+        if not item_ids:
+            return
 
-    def apply_data(self):
         self.ctx.panel.state.items = None
-        data_paths_dict = {f"items.{k}": v for k, v in self._data.items()}
+        data_paths_dict = {
+            f"items.{k}": _to_json_data(self._data[k]) for k in item_ids
+        }
         self.panel.set_data(data_paths_dict)
 
     def get_item(self, item_id):
@@ -728,32 +820,42 @@ class DashboardState(object):
     def remove_item(self, item_id):
         # @todo properly handle clearing of state/data
         self._items.pop(item_id)
+        self._dirty.add(item_id)
 
     def clear_items(self):
+        self._dirty.update(self._items.keys())
         self._items = {}
 
     def get_next_item_id(self):
-        return f"plot_{random.randint(0, 1000)}"
+        while True:
+            item_id = f"plot_{self._next_id}"
+            self._next_id += 1
+
+            # Dashboards may contain ids that were not generated sequentially
+            if item_id not in self._items:
+                return item_id
 
     def add_plot(self, item):
         self._items[item.name] = item
+        self._dirty.add(item.name)
 
         data = self.load_plot_data_for_item(item)
 
         self._data[item.name] = data
-        self.apply_data()
+        self.apply_data(only=[item.name])
 
     def edit_plot(self, item):
         self._items[item.name] = item
+        self._dirty.add(item.name)
 
         data = self.load_plot_data_for_item(item)
 
         self._data[item.name] = data
-        self.apply_data()
+        self.apply_data(only=[item.name])
 
     def load_plot_data(self, plot_id):
         item = self.get_item(plot_id)
-        if item is None:
+        if item is None or not self.can_load_data(item):
             return {}
 
         data = self.load_plot_data_for_item(item)
@@ -763,6 +865,83 @@ class DashboardState(object):
         return {}
 
     def load_plot_data_for_item(self, item):
+        if item.use_code:
+            data = self.load_data_from_code(item.code, item.type)
+        else:
+            aggregations = self.get_aggregations(item)
+            if aggregations:
+                results = self.view.aggregate(aggregations)
+            else:
+                results = None
+
+            data = self.parse_aggregation_results(item, results)
+
+        return self._format_plot_data(item, data)
+
+    def load_all_plot_data(self):
+        # Batch the aggregations of all plots so that the view is only
+        # aggregated once, rather than once per plot
+        aggregations = []
+        batched_items = []
+        for item in self.items:
+            if not self.can_load_data(item):
+                self._data[item.name] = {}
+            elif item.use_code:
+                self._data[item.name] = self.load_plot_data_for_item(item)
+            else:
+                start = len(aggregations)
+                aggregations.extend(self.get_aggregations(item))
+                batched_items.append((item, start, len(aggregations)))
+
+        if aggregations:
+            results = self.view.aggregate(aggregations)
+            for item, start, end in batched_items:
+                data = self.parse_aggregation_results(item, results[start:end])
+                data = self._format_plot_data(item, data)
+                self._data[item.name] = data
+
+        self.apply_data()
+
+    def get_aggregations(self, item):
+        if item.type in REQUIRES_FIELD:
+            if not item.field:
+                return []
+
+            return [fo.CountValues(item.field)]
+
+        if item.type == PlotType.NUMERIC_HISTOGRAM:
+            if not item.x_field:
+                return []
+
+            return [fo.HistogramValues(item.x_field, bins=item.bins)]
+
+        if not item.x_field or not item.y_field:
+            return []
+
+        aggregations = [fo.Values(F(item.x_field)), fo.Values(F(item.y_field))]
+        if item.type == PlotType.SCATTER:
+            aggregations.append(fo.Values("id"))
+
+        return aggregations
+
+    def parse_aggregation_results(self, item, results):
+        if not results:
+            return {}
+
+        if item.type == PlotType.CATEGORICAL_HISTOGRAM:
+            return self.load_categorical_histogram_data(item, *results)
+        elif item.type == PlotType.NUMERIC_HISTOGRAM:
+            return self.load_numeric_histogram_data(item, *results)
+        elif item.type == PlotType.SCATTER:
+            return self.load_scatter_data(item, *results)
+        elif item.type == PlotType.LINE:
+            return self.load_line_data(item, *results)
+        elif item.type == PlotType.PIE:
+            return self.load_pie_data(item, *results)
+
+        return {}
+
+    def _format_plot_data(self, item, data):
         fo_orange = "rgb(255, 109, 5)"
         bar_color = {"marker": {"color": fo_orange}}
         pie_color = {
@@ -775,19 +954,6 @@ class DashboardState(object):
             }
         }
 
-        if item.use_code:
-            data = self.load_data_from_code(item.code, item.type)
-        elif item.type == PlotType.CATEGORICAL_HISTOGRAM:
-            data = self.load_categorical_histogram_data(item)
-        elif item.type == PlotType.NUMERIC_HISTOGRAM:
-            data = self.load_numeric_histogram_data(item)
-        elif item.type == PlotType.SCATTER:
-            data = self.load_scatter_data(item)
-        elif item.type == PlotType.LINE:
-            data = self.load_line_data(item)
-        elif item.type == PlotType.PIE:
-            data = self.load_pie_data(item)
-
         if isinstance(data, dict):
             plot_data_type = data.get("type", None)
             if plot_data_type == "pie":
@@ -804,19 +970,7 @@ class DashboardState(object):
             return {"name": item.label, **data}
         return {}
 
-    def load_all_plot_data(self):
-        for item in self.items:
-            data = self.load_plot_data(item.name)
-            self._data[item.name] = data
-
-        self.apply_data()
-
-    def load_categorical_histogram_data(self, item):
-        field = item.field
-        if not field:
-            return {}
-
-        counts = self.view.count_values(field)
+    def load_categorical_histogram_data(self, item, counts):
         raw_keys = list(counts.keys())
         keys = [str(k) for k in raw_keys]
 
@@ -845,37 +999,27 @@ class DashboardState(object):
 
         return histogram_data
 
-    def load_numeric_histogram_data(self, item):
-        x = item.x_field
-        if not x:
-            return {}
-
-        bins = item.bins
-        counts, edges, _ = self.view.histogram_values(x, bins=bins)
-
-        counts = np.asarray(counts)
-        edges = np.asarray(edges)
+    def load_numeric_histogram_data(self, item, histogram):
+        counts, edges, _ = histogram
 
+        # The counts and left edges are already lists, so only the widths
+        # need numpy
         left_edges = edges[:-1]
-        widths = edges[1:] - edges[:-1]
+        widths = np.diff(edges)
 
         histogram_data = {
-            "x": left_edges.tolist(),
-            "y": counts.tolist(),
+            "x": left_edges,
+            "y": counts,
             "type": "bar",
-            "width": widths.tolist(),
+            "width": widths,
         }
 
         return histogram_data
 
-    def load_scatter_data(self, item):
-        x = self.view.values(F(item.x_field))
-        y = self.view.values(F(item.y_field))
+    def load_scatter_data(self, item, x, y, ids):
         if not x or not y:
             return {}
 
-        ids = self.view.values("id")
-
         scatter_data = {
             "x": x,
             "y": y,
@@ -886,32 +1030,23 @@ class DashboardState(object):
 
         return scatter_data
 
-    def load_line_data(self, item):
-        if item.x_field is None or item.y_field is None:
-            return {}
-
-        x = self.view.values(F(item.x_field))
-        y = self.view.values(F(item.y_field))
-
+    def load_line_data(self, item, x, y):
         line_data = {"x": x, "y": y, "type": "line"}
 
         return line_data
 
-    def load_pie_data(self, item):
-        field = item.field
-        if not field:
-            return {}
-
-        counts = self.view.count_values(field)
-        values = list(counts.values())
+    def load_pie_data(self, item, counts):
         keys = list(counts.keys())
-        total = np.sum(values)
-        factor = 100.0 / total
-        factored_values = [v * factor for v in values]
+        values = np.fromiter(
+            counts.values(), dtype=np.float64, count=len(counts)
+        )
+        total = values.sum()
+        if total > 0:
+            values *= 100.0 / total
 
-        pie_data = {"values": factored_values, "labels": keys, "type": "pie"}
+        pie_data = {"values": values, "labels": keys, "type": "pie"}
 
-        if len(values) > 10:
+        if len(keys) > 10:
             pie_data["textinfo"] = "none"
 
         return pie_data
@@ -920,28 +1055,29 @@ class DashboardState(object):
         if not code:
             return {}
 
-        local_vars = {}
         try:
-            exec(code, {"ctx": self.ctx}, local_vars)
-            data = local_vars.get("data", {})
+            # Each run gets a fresh namespace so that plots can't leak
+            # variables into each other
+            namespace = {"ctx": self.ctx}
+            exec(_compile_code(code), namespace)
+            data = namespace.get("data", {})
             data["type"] = _get_plotly_plot_type(plot_type).value
             return data
-        except Exception as e:
+        except Exception:
+            logger.warning("Failed to load custom plot data", exc_info=True)
             return {}
 
     def can_load_data(self, item):
-        if item.code:
-            return True
-        if item.type == PlotType.CATEGORICAL_HISTOGRAM:
-            return item.field is not None
-        elif item.type == PlotType.NUMERIC_HISTOGRAM:
-            return item.x_field is not None
-        elif item.type == PlotType.SCATTER:
-            return item.x_field is not None and item.y_field is not None
-        elif item.type == PlotType.LINE:
-            return item.x_field is not None and item.y_field is not None
-        elif item.type == PlotType.PIE:
-            return item.field is not None
+        if item.use_code:
+            return bool(item.code)
+        if item.type in REQUIRES_FIELD and not item.field:
+            return False
+        if item.type in REQUIRES_X and not item.x_field:
+            return False
+        if item.type in REQUIRES_Y and not item.y_field:
+            return False
+
+        return True
 
 
 def _can_edit(ctx):
@@ -953,26 +1089,21 @@ def _can_edit(ctx):
 
 
 def _get_plotly_plot_type(plot_type):
-    return {
-        PlotType.CATEGORICAL_HISTOGRAM: PlotlyPlotType.BAR,
-        PlotType.NUMERIC_HISTOGRAM: PlotlyPlotType.BAR,
-        PlotType.LINE: PlotlyPlotType.LINE,
-        PlotType.SCATTER: PlotlyPlotType.SCATTER,
-        PlotType.PIE: PlotlyPlotType.PIE,
-    }.get(plot_type)
+    return PLOTLY_PLOT_TYPES.get(plot_type)
 
 
 def _get_plotly_config_and_layout(plot_config):
     layout = {}
-    title = None
-    if plot_config.get("plot_title"):
-        title = plot_config.get("plot_title")
-    if plot_config.get("color"):
-        layout["marker"] = {"color": plot_config["color"].get("hex")}
-    if plot_config.get("xaxis"):
-        layout["xaxis"] = plot_config.get("xaxis")
-    if plot_config.get("yaxis"):
-        layout["yaxis"] = plot_config.get("yaxis")
+    title = plot_config.get("plot_title") or None
+    color = plot_config.get("color")
+    xaxis = plot_config.get("xaxis")
+    yaxis = plot_config.get("yaxis")
+    if color:
+        layout["marker"] = {"color": color.get("hex")}
+    if xaxis:
+        layout["xaxis"] = xaxis
+    if yaxis:
+        layout["yaxis"] = yaxis
     if plot_config.get("plot_type") == "numeric_histogram":
         layout["bargap"] = 0
         layout["bargroupgap"] = 0
@@ -980,13 +1111,86 @@ def _get_plotly_config_and_layout(plot_config):
     return {"config": {}, "layout": layout, "title": title}
 
 
+def _load_preview_data(dashboard_state, item):
+    # Scatter and line payloads hold every sample's values, so they are too
+    # large to keep around
+    if item.type in REQUIRES_Y:
+        return dashboard_state.load_plot_data_for_item(item)
+
+    # Only rerun the aggregation when a data-related input or the samples
+    # changed
+    view = dashboard_state.view
+    key = (
+        _get_collection_key(view),
+        _get_samples_version(view),
+        item.data_key,
+    )
+    preview_data = _PREVIEW_CACHE.get(key, None)
+    if preview_data is None:
+        preview_data = dashboard_state.load_plot_data_for_item(item)
+        _PREVIEW_CACHE.set(key, preview_data)
+
+    return preview_data
+
+
+@functools.lru_cache(maxsize=64)
+def _compile_code(code):
+    return compile(code, "<dashboard_plot>", "exec")
+
+
+def _to_json_data(data):
+    # Plot data may contain numpy arrays, which are only converted to lists
+    # here, right before being sent to the App
+    return {
+        k: v.tolist() if isinstance(v, np.ndarray) else v
+        for k, v in data.items()
+    }
+
+
+def _get_view_key(sample_collection):
+    return json_util.dumps(
+        [
+            sample_collection.dataset_name,
+            sample_collection.view()._serialize(),
+        ],
+        sort_keys=True,
+    )
+
+
+def _get_collection_key(sample_collection):
+    dataset = sample_collection._root_dataset
+    return dataset.last_modified_at, _get_view_key(sample_collection)
+
+
+def _get_samples_version(sample_collection):
+    # The dataset's last_modified_at is not updated when samples are added,
+    # edited, or deleted, so the samples themselves must be checked
+    aggregations = [fo.Count(), fo.Max("last_modified_at")]
+    if sample_collection._has_frame_fields():
+        aggregations.extend(
+            [fo.Count("frames"), fo.Max("frames.last_modified_at")]
+        )
+
+    return tuple(sample_collection.aggregate(aggregations))
+
+
 def _get_fields_with_type(dataset, field_types, root=None):
+    key = (_get_collection_key(dataset), field_types)
+    paths = _SCHEMA_CACHE.get(key, None)
+    if paths is None:
+        paths = tuple(_find_fields_with_type(dataset, field_types))
+        _SCHEMA_CACHE.set(key, paths)
+
+    if root is not None:
+        return [path for path in paths if path.startswith(root + ".")]
+
+    return list(paths)
+
+
+def _find_fields_with_type(dataset, field_types):
     schema = dataset.get_field_schema(flat=True)
     paths = []
     for path, field in schema.items():
-        if root is not None and not path.startswith(root + "."):
-            continue
-
         if isinstance(field, field_types) or (
             isinstance(field, fo.ListField)
             and isinstance(field.field, field_types)
@@ -1027,6 +1231,11 @@ def _make_view_for_range(sample_collection, path, min_val, max_val):
     return sample_collection.match(expr)
 
 
+def _make_view_for_point(sample_collection, x_path, x, y_path, y):
+    expr = (F(x_path) == x) & (F(y_path) == y)
+    return sample_collection.match(expr)
+
+
 def _is_field_type(sample_collection, path, field_or_type):
     field = sample_collection.get_field(path)
 
@@ -1047,12 +1256,14 @@ def _parse_path(sample_collection, path):
     leaf = chunks[-1]
 
     # Handle dynamic documents
-    idx = 0
-    while _is_field_type(
-        sample_collection, root, fo.EmbeddedDocumentField
-    ) and not _is_field_type(sample_collection, root, fo.Label):
-        idx += 1
-        root += "." + chunks[idx]
+    for chunk in chunks[1:]:
+        field = sample_collection.get_field(root)
+        if not isinstance(field, fo.EmbeddedDocumentField) or issubclass(
+            field.document_type, fo.Label
+        ):
+            break
+
+        root += "." + chunk
 
     return root, leaf
 